@@ -0,0 +1,127 @@
+"""Benchmark prima/dopo dell'accesso al database per gli handler principali.
+
+"Prima": ogni helper apre la propria connessione, chiusa a fine handler (comportamento storico).
+"Dopo": connessione per thread condivisa da get_db() con PRAGMA impostati una volta.
+
+Prima di ogni chiamata, in entrambi i casi, vengono svuotate le cache che
+evitano le query degli handler (profili, riepilogo di "Chi tocca", pagine): i
+tempi misurano l'accesso al database e non quelle cache. Resta calda solo la
+tabella delle eccezioni ai turni, costruita una volta per processo.
+
+Uso: python benchmark_db.py [ripetizioni]
+Il database di prova viene creato in una cartella temporanea.
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+RIPETIZIONI = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+os.chdir(tempfile.mkdtemp(prefix='bench_turni_'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bot  # noqa: E402
+
+bot.init_db()  # crea e popola il database di prova
+
+USER_ID = bot.SUPER_USER_IDS[0]
+
+
+async def _nessuna_risposta(*args, **kwargs):
+    return None
+
+
+def crea_update_messaggio():
+    utente = SimpleNamespace(id=USER_ID, first_name='Bench', username='bench')
+    messaggio = SimpleNamespace(reply_text=_nessuna_risposta, chat_id=USER_ID)
+    return SimpleNamespace(effective_user=utente, message=messaggio, callback_query=None)
+
+
+def crea_update_callback(data):
+    utente = SimpleNamespace(id=USER_ID, first_name='Bench', username='bench')
+    query = SimpleNamespace(data=data, from_user=utente, answer=_nessuna_risposta,
+                            edit_message_text=_nessuna_risposta,
+                            message=SimpleNamespace(chat_id=USER_ID))
+    return SimpleNamespace(effective_user=utente, message=None, callback_query=query)
+
+
+def crea_context():
+    # Come il pre-handler prepara_contesto_richiesta: un caricamento per Update
+    return SimpleNamespace(user_data={}, richiesta=bot.carica_contesto_richiesta(USER_ID),
+                           bot=SimpleNamespace(send_message=_nessuna_risposta,
+                                               send_document=_nessuna_risposta))
+
+
+HANDLER = [
+    ('chi_tocca', lambda: bot.chi_tocca(crea_update_messaggio(), crea_context())),
+    ('prossimi_turni', lambda: bot.prossimi_turni(crea_update_messaggio(), crea_context())),
+    ('statistiche', lambda: bot.statistiche(crea_update_messaggio(), crea_context())),
+    ('cerca_sostituto (sera)', lambda: bot.gestisci_cerca_sostituto(
+        crea_update_callback('so:sera'), crea_context(), 'sera')),
+    ('turni_settimana', lambda: bot.mostra_turni_settimana(crea_update_callback('tw'), crea_context())),
+]
+
+
+class ConnessioniNonCondivise:
+    """Sostituto di get_db() per il caso "prima": una connessione nuova a ogni chiamata"""
+
+    def __init__(self):
+        self.aperte = []
+
+    def __call__(self):
+        # Gli helper girano nel pool del database: la chiusura avviene dal thread principale
+        conn = sqlite3.connect(bot.DATABASE_NAME, check_same_thread=False)
+        self.aperte.append(conn)
+        return conn
+
+    def chiudi(self):
+        for conn in self.aperte:
+            conn.close()
+        self.aperte.clear()
+
+
+def svuota_cache():
+    bot.invalida_cache_utenti()
+    bot._riepilogo_chi_tocca = None
+    bot._cache_pagine.clear()
+    bot._candidati_sostituzione.clear()
+
+
+def misura(chiamata, connessioni=None):
+    loop = asyncio.new_event_loop()
+
+    def esegui():
+        svuota_cache()
+        loop.run_until_complete(chiamata())
+        if connessioni:
+            connessioni.chiudi()
+
+    try:
+        esegui()  # riscaldamento
+        inizio = time.perf_counter()
+        for _ in range(RIPETIZIONI):
+            esegui()
+        return (time.perf_counter() - inizio) / RIPETIZIONI * 1000
+    finally:
+        loop.close()
+
+
+def main():
+    get_db_condiviso = bot.get_db
+
+    print(f"⏱️  BENCHMARK HANDLER ({RIPETIZIONI} ripetizioni, ms per chiamata)")
+    print(f"{'handler':<26}{'prima':>10}{'dopo':>10}{'speedup':>10}")
+    for nome, chiamata in HANDLER:
+        connessioni = ConnessioniNonCondivise()
+        bot.get_db = connessioni
+        prima = misura(chiamata, connessioni)
+        bot.get_db = get_db_condiviso
+        dopo = misura(chiamata)
+        print(f"{nome:<26}{prima:>10.3f}{dopo:>10.3f}{prima / dopo:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
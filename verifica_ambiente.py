@@ -2,8 +2,13 @@ import os
 
 print("🔍 VERIFICA VARIABILI AMBIENTE")
 print("BOT_TOKEN:", "✅ PRESENTE" if os.environ.get('BOT_TOKEN') else "❌ MANCANTE")
+print("BACKUP_BACKEND:", os.environ.get('BACKUP_BACKEND', 'gist'),
+      f"(cartella {os.environ.get('BACKUP_DIR', 'backup')})" if os.environ.get('BACKUP_BACKEND') == 'locale' else "")
 print("GITHUB_TOKEN:", "✅ PRESENTE" if os.environ.get('GITHUB_TOKEN') else "❌ MANCANTE")
 print("GIST_ID:", "✅ PRESENTE" if os.environ.get('GIST_ID') else "⚠️  NON ANCORA CREATO")
+print("API_TOKEN:", "✅ PRESENTE" if os.environ.get('API_TOKEN')
+      else "⚠️  API PUBBLICHE (API_PUBBLICA=1)" if os.environ.get('API_PUBBLICA') == '1'
+      else "⚠️  MANCANTE - API JSON disattivate")
 
 # Test database
 try:
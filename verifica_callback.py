@@ -0,0 +1,58 @@
+"""Controlla che solo il router risponda alle callback query.
+
+gestisci_callback risponde a ogni query prima di chiamare l'handler della
+rotta: Telegram rifiuta una seconda risposta, quindi nessun'altra funzione di
+bot.py (gli handler di ROTTE_CALLBACK e quelli che chiamano) deve chiamare
+answer() su una callback query. Fallisce (exit code 1) se ne trova una, o se
+un handler di ROTTE_CALLBACK non è una funzione di bot.py.
+
+Uso: python verifica_callback.py
+"""
+import ast
+import os
+import sys
+import tempfile
+
+CARTELLA_BOT = os.path.dirname(os.path.abspath(__file__))
+FILE_BOT = os.path.join(CARTELLA_BOT, 'bot.py')
+ROUTER = 'gestisci_callback'
+
+
+def risposte_fuori_dal_router(sorgente):
+    """[(riga, funzione)] delle chiamate answer() fuori da gestisci_callback"""
+    trovate = []
+    for funzione in ast.walk(ast.parse(sorgente)):
+        if not isinstance(funzione, (ast.FunctionDef, ast.AsyncFunctionDef)) or funzione.name == ROUTER:
+            continue
+        for nodo in ast.walk(funzione):
+            if (isinstance(nodo, ast.Call) and isinstance(nodo.func, ast.Attribute)
+                    and nodo.func.attr == 'answer'):
+                trovate.append((nodo.lineno, funzione.name))
+    return trovate
+
+
+def main():
+    with open(FILE_BOT, encoding='utf-8') as f:
+        sorgente = f.read()
+
+    os.chdir(tempfile.mkdtemp(prefix='verifica_callback_'))
+    sys.path.insert(0, CARTELLA_BOT)
+    import bot
+
+    errori = 0
+    for riga, funzione in risposte_fuori_dal_router(sorgente):
+        errori += 1
+        print(f"❌ bot.py:{riga} - {funzione} risponde alla query: lo fa già {ROUTER}")
+    for prefisso, (handler, _, _) in bot.ROTTE_CALLBACK.items():
+        if handler is not None and getattr(bot, handler.__name__, None) is not handler:
+            errori += 1
+            print(f"❌ rotta '{prefisso}': {handler!r} non è una funzione di bot.py")
+
+    if errori:
+        print(f"\n❌ {errori} problemi nelle risposte alle callback query")
+        sys.exit(1)
+    print(f"✅ {len(bot.ROTTE_CALLBACK)} rotte controllate: solo {ROUTER} risponde alle query")
+
+
+if __name__ == '__main__':
+    main()
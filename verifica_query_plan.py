@@ -0,0 +1,202 @@
+"""Controlla con EXPLAIN QUERY PLAN tutte le query SQL di bot.py.
+
+Fallisce (exit code 1) se una query esegue una scansione completa delle
+tabelle turni o cambi invece di usare un indice, o se il testo SQL di una
+chiamata execute/executemany non si ricava dal sorgente (stringa letterale,
+variabile assegnata con una stringa nella funzione o nel modulo, variabile di
+un ciclo for su una sequenza di stringhe del modulo). Le query che scandiscono
+tutta la tabella di proposito lo dichiarano con il commento SQL
+"-- query-plan: scansione completa voluta".
+
+Uso: python verifica_query_plan.py
+Il database di prova viene creato in una cartella temporanea.
+"""
+import ast
+import os
+import re
+import sys
+import tempfile
+
+CARTELLA_BOT = os.path.dirname(os.path.abspath(__file__))
+FILE_BOT = os.path.join(CARTELLA_BOT, 'bot.py')
+TABELLE_CONTROLLATE = ('turni', 'cambi')
+COMANDI_SQL = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+SCANSIONE_VOLUTA = '-- query-plan: scansione completa voluta'
+
+
+def testo_sql(nodo):
+    """Restituisce il testo di una stringa (anche f-string) o None"""
+    if isinstance(nodo, ast.Constant) and isinstance(nodo.value, str):
+        return nodo.value
+    if isinstance(nodo, ast.JoinedStr):
+        parti = []
+        for valore in nodo.values:
+            if isinstance(valore, ast.Constant):
+                parti.append(valore.value)
+            else:
+                parti.append('NULL')
+        return ''.join(parti)
+    return None
+
+
+def stringhe_in(nodo):
+    """Testi di tutte le stringhe (anche f-string) contenute in un'espressione"""
+    testo = testo_sql(nodo)
+    if testo is not None:
+        return [testo]
+    testi = []
+    for figlio in ast.iter_child_nodes(nodo):
+        testi.extend(stringhe_in(figlio))
+    return testi
+
+
+class RaccoltaQuery(ast.NodeVisitor):
+    """Raccoglie le chiamate execute/executemany e le assegnazioni dei nomi, per funzione"""
+
+    def __init__(self):
+        self.funzioni = [None]  # None: livello di modulo
+        self.definizioni = {}   # (funzione, nome): [(riga, 'assegnazione' o 'for', espressione)]
+        self.chiamate = []      # (funzione, riga, primo argomento)
+
+    def visit_FunctionDef(self, nodo):
+        self.funzioni.append(nodo)
+        self.generic_visit(nodo)
+        self.funzioni.pop()
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def definisci(self, bersaglio, riga, tipo, valore):
+        if isinstance(bersaglio, ast.Name):
+            self.definizioni.setdefault((self.funzioni[-1], bersaglio.id), []).append((riga, tipo, valore))
+
+    def visit_Assign(self, nodo):
+        for bersaglio in nodo.targets:
+            self.definisci(bersaglio, nodo.lineno, 'assegnazione', nodo.value)
+        self.generic_visit(nodo)
+
+    def visit_For(self, nodo):
+        self.definisci(nodo.target, nodo.lineno, 'for', nodo.iter)
+        self.generic_visit(nodo)
+
+    def visit_Call(self, nodo):
+        if isinstance(nodo.func, ast.Attribute) and nodo.func.attr in ('execute', 'executemany') and nodo.args:
+            self.chiamate.append((self.funzioni[-1], nodo.lineno, nodo.args[0]))
+        self.generic_visit(nodo)
+
+    def risolvi(self, nodo, funzione, riga):
+        """Testi SQL possibili per un argomento, o None se non si sa ricavarli"""
+        testo = testo_sql(nodo)
+        if testo is not None:
+            return [testo]
+        if isinstance(nodo, (ast.ListComp, ast.GeneratorExp)):
+            nodo = nodo.generators[0].iter
+        if isinstance(nodo, (ast.List, ast.Tuple)):
+            testi = [self.risolvi(elemento, funzione, riga) for elemento in nodo.elts]
+            return None if None in testi else [t for gruppo in testi for t in gruppo]
+        if isinstance(nodo, ast.Subscript):
+            nodo = nodo.value
+        if not isinstance(nodo, ast.Name):
+            return None
+        # Tutte le definizioni precedenti nella funzione (anche in rami diversi),
+        # altrimenti quella di modulo
+        for ambito in (funzione, None):
+            precedenti = [d for d in self.definizioni.get((ambito, nodo.id), [])
+                          if ambito is None or d[0] <= riga]
+            if not precedenti:
+                continue
+            testi = []
+            for riga_definizione, tipo, valore in precedenti:
+                if tipo == 'for':
+                    # Variabile di un ciclo for: tutte le stringhe della sequenza percorsa
+                    valore = valore.value if isinstance(valore, ast.Subscript) else valore
+                if ambito is None and not isinstance(valore, ast.Name):
+                    risolti = stringhe_in(valore) or None
+                else:
+                    risolti = self.risolvi(valore, ambito, riga_definizione)
+                if risolti is None:
+                    return None
+                testi.extend(risolti)
+            return testi
+        return None
+
+
+def estrai_query(sorgente):
+    """Trova tutte le stringhe SQL passate a execute/executemany in bot.py, anche tramite variabili.
+
+    Restituisce (query, righe delle chiamate il cui SQL non si riesce a ricavare).
+    """
+    raccolta = RaccoltaQuery()
+    raccolta.visit(ast.parse(sorgente))
+    query = []
+    non_risolte = []
+    for funzione, riga, argomento in raccolta.chiamate:
+        testi = raccolta.risolvi(argomento, funzione, riga)
+        if testi is None:
+            non_risolte.append((riga, ast.unparse(argomento)))
+            continue
+        for sql in testi:
+            if sql.strip().upper().startswith(COMANDI_SQL):
+                query.append((riga, sql))
+    return query, non_risolte
+
+
+def alias_controllati(sql):
+    """Nomi (tabella o alias) con cui turni e cambi compaiono nella query"""
+    nomi = set()
+    for tabella, alias in re.findall(r'(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.IGNORECASE):
+        if tabella.lower() in TABELLE_CONTROLLATE:
+            nomi.add(tabella.lower())
+            if alias and alias.upper() not in ('WHERE', 'ON', 'JOIN', 'SET', 'ORDER', 'GROUP', 'LIMIT', 'VALUES', 'LEFT'):
+                nomi.add(alias.lower())
+    return nomi
+
+
+def scansioni_complete(conn, sql):
+    """Restituisce le righe del piano che scandiscono per intero turni o cambi"""
+    nomi = alias_controllati(sql)
+    if not nomi:
+        return []
+    parametri = [None] * sql.count('?')
+    piano = conn.execute('EXPLAIN QUERY PLAN ' + sql, parametri).fetchall()
+    problemi = []
+    for riga in piano:
+        dettaglio = riga[-1]
+        trovato = re.match(r'SCAN (?:TABLE )?(\w+)', dettaglio)
+        if trovato and trovato.group(1).lower() in nomi and 'INDEX' not in dettaglio:
+            problemi.append(dettaglio)
+    return problemi
+
+
+def main():
+    with open(FILE_BOT, encoding='utf-8') as f:
+        sorgente = f.read()
+
+    os.chdir(tempfile.mkdtemp(prefix='query_plan_'))
+    sys.path.insert(0, CARTELLA_BOT)
+    import bot
+    bot.init_db()
+
+    conn = bot.get_db()
+    errori = 0
+    query, non_risolte = estrai_query(sorgente)
+    for riga, argomento in non_risolte:
+        errori += 1
+        print(f"❌ bot.py:{riga} - SQL non ricavabile staticamente: {argomento}")
+    for riga, sql in query:
+        if SCANSIONE_VOLUTA in sql:
+            print(f"ℹ️  bot.py:{riga} - scansione completa dichiarata, ignorata")
+            continue
+        problemi = scansioni_complete(conn, sql)
+        if problemi:
+            errori += 1
+            print(f"❌ bot.py:{riga} - scansione completa: {', '.join(problemi)}")
+            print('   ' + ' '.join(sql.split()))
+
+    if errori:
+        print(f"\n❌ {errori} query su {len(query)} senza indice su {'/'.join(TABELLE_CONTROLLATE)}")
+        sys.exit(1)
+    print(f"✅ {len(query)} query controllate: nessuna scansione completa di {'/'.join(TABELLE_CONTROLLATE)}")
+
+
+if __name__ == '__main__':
+    main()
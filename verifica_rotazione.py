@@ -0,0 +1,111 @@
+"""Verifica che il motore di rotazione coincida con il calendario storico.
+
+Confronta, giorno per giorno, i turni sera/notte/festivo calcolati da
+turni_rotazione() con un riferimento indipendente dal motore:
+
+- senza argomenti, con il ciclo giorno per giorno di genera_calendario_automatico
+  com'era prima del motore a rotazione (copiato qui sotto, con le sue sequenze
+  e i suoi indici iniziali, e da non allineare a bot.py);
+- con un percorso, con la tabella turni del database indicato (aperto in sola
+  lettura), che deve essere stato generato da una versione precedente al
+  motore: un database generato dal motore stesso renderebbe il confronto
+  tautologico.
+
+Uso: python verifica_rotazione.py [percorso_db]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+CARTELLA_BOT = os.path.dirname(os.path.abspath(__file__))
+PERCORSO_DB = os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 else None
+
+os.chdir(tempfile.mkdtemp(prefix='verifica_rotazione_'))
+sys.path.insert(0, CARTELLA_BOT)
+import bot  # noqa: E402
+
+# Copia del generatore storico: non usare le costanti di bot.py
+INIZIO_RIFERIMENTO = date(2025, 11, 1)
+GIORNI_RIFERIMENTO = 5 * 365
+
+
+def calendario_riferimento():
+    """Turni sera/notte/festivo per data, calcolati avanzando gli indici un giorno alla volta"""
+    sequenza_serale = ["S1", "S2", "S3", "S4", "S5", "S6", "S7"]
+    sequenza_notturna_feriale = ["An", "Bn", "Cn"]
+    sequenza_notturna_weekend = ["S1n", "S2n"]
+    sequenza_festiva = ["A", "B", "C", "D"]
+    idx_serale = 2
+    idx_notturno_feriale = 2
+    idx_notturno_weekend = 1
+    idx_festivo = 2
+
+    tabella = {}
+    data_corrente = INIZIO_RIFERIMENTO
+    data_fine = data_corrente + timedelta(days=GIORNI_RIFERIMENTO)
+    while data_corrente <= data_fine:
+        giorno_settimana = data_corrente.weekday()
+        turni = tabella.setdefault(data_corrente.isoformat(), set())
+
+        if giorno_settimana != 5:
+            turni.add(('sera', sequenza_serale[idx_serale % len(sequenza_serale)]))
+
+        if giorno_settimana == 4:
+            turni.add(('notte', sequenza_notturna_weekend[idx_notturno_weekend % len(sequenza_notturna_weekend)]))
+            idx_notturno_weekend += 1
+        elif giorno_settimana in [0, 1, 2, 3]:
+            turni.add(('notte', sequenza_notturna_feriale[idx_notturno_feriale % len(sequenza_notturna_feriale)]))
+            idx_notturno_feriale += 1
+
+        if giorno_settimana == 5:
+            turni.add(('festivo', sequenza_festiva[idx_festivo % len(sequenza_festiva)]))
+            idx_festivo += 1
+
+        if giorno_settimana != 5:
+            idx_serale += 1
+        data_corrente += timedelta(days=1)
+    return tabella
+
+
+def tabella_database(percorso):
+    """Turni sera/notte/festivo per data letti dal database indicato"""
+    conn = sqlite3.connect(f"file:{percorso}?mode=ro", uri=True)
+    tabella = {}
+    segnaposto = ','.join('?' * len(bot.TIPI_ROTAZIONE))
+    for data, tipo, squadra in conn.execute(
+            f"SELECT data, tipo_turno, squadra FROM turni WHERE tipo_turno IN ({segnaposto})",
+            bot.TIPI_ROTAZIONE):
+        tabella.setdefault(data, set()).add((tipo, squadra))
+    conn.close()
+    return tabella
+
+
+def main():
+    if PERCORSO_DB:
+        tabella, origine = tabella_database(PERCORSO_DB), 'tabella'
+    else:
+        tabella, origine = calendario_riferimento(), 'generatore storico'
+
+    if not tabella:
+        print("❌ La tabella turni è vuota")
+        sys.exit(1)
+
+    differenze = []
+    for data_iso in sorted(tabella):
+        calcolati = set(bot.turni_rotazione(datetime.strptime(data_iso, '%Y-%m-%d').date()))
+        if calcolati != tabella[data_iso]:
+            differenze.append((data_iso, sorted(tabella[data_iso]), sorted(calcolati)))
+
+    prima, ultima = min(tabella), max(tabella)
+    if differenze:
+        for data_iso, attesi, calcolati in differenze[:20]:
+            print(f"❌ {data_iso}: {origine} {attesi} - rotazione {calcolati}")
+        print(f"\n❌ {len(differenze)} giorni su {len(tabella)} non coincidono ({prima} → {ultima})")
+        sys.exit(1)
+    print(f"✅ Rotazione e {origine} coincidono su {len(tabella)} giorni ({prima} → {ultima})")
+
+
+if __name__ == '__main__':
+    main()